@@ -34,7 +34,7 @@ if [ -f "requirements.txt" ]; then
     pip install -r requirements.txt
 else
     echo "⚠️ 未找到requirements.txt，使用默认依赖安装..."
-    pip install streamlit==1.35.0 PyPDF2==3.0.1 requests==2.31.0 jieba==0.42.1 python-dotenv==1.0.0
+    pip install streamlit==1.35.0 pypdfium2==4.26.0 requests==2.31.0 jieba==0.42.1 numpy==1.26.3 scikit-learn==1.4.0 rapidfuzz==3.6.1 scipy==1.12.0 orjson==3.9.15
 fi
 
 # 检查是否安装成功
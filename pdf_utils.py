@@ -0,0 +1,29 @@
+"""PDF文本提取：独立于Streamlit脚本，PDFium锁在进程内只创建一次"""
+import threading
+from typing import List
+
+import pypdfium2 as pdfium
+
+# PDF文本清理：删除换行和回车的转换表
+_LINE_BREAKS = str.maketrans("", "", "\r\n")
+
+# PDFium不是线程安全的。本模块每个进程只导入一次（Streamlit每次重跑都会重建脚本模块），
+# 锁放在这里才能让同一进程内所有会话的调用真正串行
+_PDFIUM_LOCK = threading.Lock()
+
+def read_pdf_text(data: bytes) -> str:
+    """用PDFium提取PDF全文并去除换行和双空格，解析失败时抛出异常"""
+    pages: List[str] = []
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(data)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                # 逐页清理：先删除双空格再删除换行，顺序不能颠倒，否则 " \n " 会整体消失，
+                # 条款编号后的空白随之丢失，"第X条\s+" 等模式将无法匹配
+                pages.append(textpage.get_text_range().replace("  ", "").translate(_LINE_BREAKS))
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    return "".join(pages)
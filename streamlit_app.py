@@ -1,13 +1,33 @@
 import streamlit as st
-from PyPDF2 import PdfReader
-from difflib import SequenceMatcher
 import base64
+import functools
+import hashlib
+import json
+import os
 import re
+import tempfile
+import threading
 import requests
-import jieba
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import jieba_fast as jieba  # Cython实现，接口与jieba一致
+except ImportError:
+    import jieba
+try:
+    from orjson import loads as json_loads  # C实现，解析流式响应的大量小片段更快
+except ImportError:
+    from json import loads as json_loads
 from io import StringIO
+from pathlib import Path
 import time
-from typing import List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Tuple, Optional
+import numpy as np
+from rapidfuzz import fuzz
+from scipy.optimize import linear_sum_assignment
+from sklearn.feature_extraction.text import TfidfVectorizer
+from pdf_utils import read_pdf_text
 
 # 页面设置
 st.set_page_config(
@@ -26,8 +46,79 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+def _env_positive_int(name: str, default: int) -> int:
+    """读取正整数环境变量；未设置或无法解析时使用默认值，小于1时按1处理"""
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
 # API配置
 QWEN_API_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+QWEN_MODEL = "qwen-plus"
+PROMPT_VERSION = "1"  # 修改提示词模板或请求参数时递增，使旧缓存失效
+QWEN_CACHE_DIR = Path(".qwen_cache")  # 跨进程持久化的响应缓存
+# 缓存内容来自用户上传的合同，磁盘缓存与内存缓存采用相同的有效期和条目上限，过期文件读取时删除
+QWEN_CACHE_TTL = 24 * 3600  # 响应缓存有效期（秒）
+QWEN_CACHE_MAX_ENTRIES = 4096  # 响应缓存条目上限，超出时删除最旧的磁盘缓存文件
+
+# 条款编号格式，按优先级依次尝试
+_CLAUSE_PATTERNS = [re.compile(pattern, re.DOTALL) for pattern in (
+    r'(第[一二三四五六七八九十百]+条\s+.*?)(?=第[一二三四五六七八九十百]+条\s+|$)',
+    r'([一二三四五六七八九十]+、\s+.*?)(?=[一二三四五六七八九十]+、\s+|$)',
+    r'(\d+\.\s+.*?)(?=\d+\.\s+|$)',
+    r'(\([一二三四五六七八九十]+\)\s+.*?)(?=\([一二三四五六七八九十]+\)\s+|$)',
+    r'(\([1-9]+\)\s+.*?)(?=\([1-9]+\)\s+|$)',
+    r'(【[^\】]+】\s+.*?)(?=【[^\】]+】\s+|$)'
+)]
+# 无编号时按句末标点切分
+_SENTENCE_SPLIT = re.compile(r'[。；！？]\s*')
+
+# 条款合规性分析要点，单条与合并分析的提示词共用（缩进与提示词正文一致，保证缓存命中）
+ANALYSIS_CHECKLIST = """1. 目标条款是否符合基准条款的要求
+    2. 存在哪些偏离或冲突之处（需具体指出）
+    3. 偏离程度评估（完全符合/轻微偏离/严重偏离）
+    4. 导致偏离的关键原因
+    5. 如何修改目标条款以符合基准要求
+    
+    请用专业、简洁的中文回答，聚焦合规性问题。"""
+
+# 目标条款与基准条款文本一致时的固定分析结论
+IDENTICAL_CLAUSE_ANALYSIS = "目标条款与基准条款文本完全一致，完全符合基准要求，不存在偏离或冲突，无需修改。"
+
+# 从模型回复中解码JSON数组（兼容```json代码块等包裹）；
+# strict=False允许字符串中出现原始换行，多要点的中文分析经常如此输出
+_JSON_DECODER = json.JSONDecoder(strict=False)
+
+# 可选的法律领域用户词典，存在时加载
+LEGAL_DICT_PATH = Path(__file__).with_name("legal_dict.txt")
+# jieba前缀词典缓存，可用环境变量JIEBA_CACHE_DIR指向持久化存储，加快容器冷启动
+JIEBA_CACHE_FILE = Path(os.environ.get("JIEBA_CACHE_DIR", tempfile.gettempdir())) / "jieba_legal.cache"
+
+# 词语到码位的映射：Streamlit每次运行脚本都会重建，只在本次运行的脚本线程内使用，
+# 保证同一次匹配中同一词语编码一致
+_TOKEN_CODES: Dict[str, str] = {}
+
+# 条款匹配配置
+# 匹配阈值。注意：相似度为RapidFuzz的Indel比率（2·LCS/总词数），总是不低于原先difflib
+# SequenceMatcher.ratio()的结果（后者按匹配块计数并自动忽略高频词），
+# 因此沿用0.3时会接受更多弱匹配、产生更多模型调用；应按实际合同样本重新校准
+MATCH_THRESHOLD = 0.3
+MATCH_CANDIDATES = 3   # 每条基准条款仅对TF-IDF最相近的若干目标条款做精确比对
+
+QWEN_MAX_CONCURRENCY = 8  # 同时进行的API请求上限
+QWEN_MAX_QPM = _env_positive_int("QWEN_MAX_QPM", 300)  # 每分钟请求数上限，按账号配额调整
+QWEN_MAX_TOKENS = 1500  # 单次回答的默认输出上限
+ANALYSIS_BATCH_SIZE = 5  # 每次请求合并分析的条款对数量上限
+ANALYSIS_BATCH_PROMPT_TOKENS = 3000  # 合并请求中条款文本的估算token上限
+ANALYSIS_TOKENS_PER_PAIR = 1000  # 合并请求中每对条款的输出预算，过小会截断JSON数组导致逐对重试
+SUMMARY_INPUT_CHARS = 6000  # 综合摘要提示词中各文件报告摘录的总字符预算
+TARGET_SUMMARY_MAX_TOKENS = 800  # 目标文件总体评估只含评分、主要问题和建议三项
+SUMMARY_BASE_TOKENS = 400  # 综合摘要的基础输出预算
+SUMMARY_TOKENS_PER_FILE = 250  # 综合摘要按文件数增加的输出预算
+QWEN_RETRY_STATUS = (429, 502, 503)  # 限流或网关错误时退避重试
+QWEN_TIMEOUT = (5, 60)  # (连接, 读取) 超时秒数，连接不上时尽快失败
+STREAM_INTERRUPTED_NOTICE = "\n\n（生成中断，以上内容不完整）"  # 流式回答中途失败时追加在已输出内容之后
 
 # 会话状态初始化
 if 'analysis_progress' not in st.session_state:
@@ -37,106 +128,297 @@ if 'partial_reports' not in st.session_state:
 if 'current_analysis' not in st.session_state:
     st.session_state.current_analysis = None
 
-def call_qwen_api(prompt: str, api_key: str) -> Optional[str]:
-    """调用API并实现重试机制"""
-    retries = 2
-    delay = 3
+class QwenAPIError(Exception):
+    """Qwen API调用失败（失败结果不写入缓存）"""
+
+class _RateLimiter:
+    """线程安全的令牌桶：允许短时突发，长期速率不超过每分钟上限"""
+    
+    def __init__(self, per_minute: int):
+        per_minute = max(1, per_minute)
+        self._rate = per_minute / 60.0
+        self._capacity = float(max(1, min(per_minute, QWEN_MAX_CONCURRENCY)))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
     
-    for attempt in range(retries):
+    def acquire(self) -> None:
+        """取得一个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+def call_qwen_api(prompt: str, api_key: str, max_tokens: int = QWEN_MAX_TOKENS) -> Optional[str]:
+    """调用API，相同提示词直接复用缓存结果"""
+    try:
+        return _cached_completion(prompt, QWEN_MODEL, max_tokens, PROMPT_VERSION, api_key)
+    except QwenAPIError:
+        return None
+
+@st.cache_data(ttl=QWEN_CACHE_TTL, max_entries=QWEN_CACHE_MAX_ENTRIES, show_spinner=False)
+def _cached_completion(prompt: str, model: str, max_tokens: int, prompt_version: str, _api_key: str) -> str:
+    """按 (提示词, 模型, 输出上限, 模板版本) 缓存响应；API密钥不参与缓存键"""
+    cache_path = _response_cache_path(prompt, model, max_tokens, prompt_version)
+    cached = _read_response_cache(cache_path)
+    if cached is not None:
+        return cached
+    
+    content = _request_completion(prompt, model, max_tokens, _api_key)
+    if content is None:
+        raise QwenAPIError(model)
+    
+    _write_response_cache(cache_path, content)
+    return content
+
+def stream_qwen_api(prompt: str, api_key: str, max_tokens: int = QWEN_MAX_TOKENS) -> Iterator[str]:
+    """流式调用API，按到达顺序产出回答片段；已缓存的回答一次性产出"""
+    cache_path = _response_cache_path(prompt, QWEN_MODEL, max_tokens, PROMPT_VERSION)
+    cached = _read_response_cache(cache_path)
+    if cached is not None:
+        yield cached
+        return
+    
+    headers = {"Authorization": f"Bearer {api_key}"}
+    data = _completion_payload(prompt, QWEN_MODEL, max_tokens)
+    data["stream"] = True
+    
+    chunks: List[str] = []
+    finished = False
+    try:
+        _qwen_rate_limiter().acquire()
+        with _qwen_session().post(QWEN_API_URL, headers=headers, json=data, timeout=QWEN_TIMEOUT, stream=True) as response:
+            if response.status_code != 200:
+                return
+            # SSE格式：每个事件一行 "data: {...}"，以 "data: [DONE]" 结束
+            for raw_line in response.iter_lines():
+                line = raw_line.decode("utf-8")
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    finished = True
+                    break
+                event = json_loads(payload)
+                # 逐层校验结构，格式异常的事件直接跳过
+                choices = event.get("choices") if isinstance(event, dict) else None
+                choice = choices[0] if isinstance(choices, list) and choices else None
+                delta = choice.get("delta") if isinstance(choice, dict) else None
+                content = delta.get("content") if isinstance(delta, dict) else None
+                if isinstance(content, str) and content:
+                    chunks.append(content)
+                    yield content
+    except (requests.RequestException, ValueError):
+        pass
+    
+    if not finished:
+        # 已输出部分内容后中断时追加提示，调用方据此判断结果不完整
+        if chunks:
+            yield STREAM_INTERRUPTED_NOTICE
+        return
+    # 只缓存完整接收的回答
+    if chunks:
+        _write_response_cache(cache_path, "".join(chunks))
+
+def _response_cache_path(prompt: str, model: str, max_tokens: int, prompt_version: str) -> Path:
+    """响应在磁盘缓存中的位置"""
+    digest = hashlib.sha256(f"{model}\x00{max_tokens}\x00{prompt_version}\x00{prompt}".encode()).hexdigest()
+    return QWEN_CACHE_DIR / f"{digest}.txt"
+
+def _read_response_cache(cache_path: Path) -> Optional[str]:
+    """读取磁盘缓存；缓存不存在、已过期或无法读取时返回None，回退到调用API"""
+    try:
+        if time.time() - cache_path.stat().st_mtime > QWEN_CACHE_TTL:
+            cache_path.unlink()
+            return None
+        return cache_path.read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def _write_response_cache(cache_path: Path, content: str) -> None:
+    """先写临时文件再原子替换，避免并发请求读到不完整的缓存
+
+    磁盘缓存只是加速手段，目录只读或磁盘已满时跳过写入，不影响本次结果。
+    """
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        QWEN_CACHE_DIR.mkdir(exist_ok=True)
+        tmp_path.write_text(content, encoding="utf-8")
+        os.replace(tmp_path, cache_path)
+    except OSError:
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            data = {
-                "model": "qwen-plus",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.2,
-                "max_tokens": 1500
-            }
-            
-            response = requests.post(
-                QWEN_API_URL,
-                headers=headers,
-                json=data,
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                response_json = response.json()
-                if "choices" in response_json and len(response_json["choices"]) > 0:
-                    return response_json["choices"][0]["message"]["content"]
-                
-        except Exception as e:
-            if attempt < retries - 1:
-                time.sleep(delay)
-                continue
-                
+            tmp_path.unlink()
+        except OSError:
+            pass
+        return
+    _prune_response_cache()
+
+def _prune_response_cache() -> None:
+    """删除过期的缓存文件，并在条目超过上限时从最旧的开始删除"""
+    try:
+        entries = []
+        for path in QWEN_CACHE_DIR.glob("*.txt"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue  # 已被其他会话删除
+    except OSError:
+        return
+    entries.sort()
+    expired_before = time.time() - QWEN_CACHE_TTL
+    excess = len(entries) - QWEN_CACHE_MAX_ENTRIES
+    for i, (mtime, path) in enumerate(entries):
+        if i >= excess and mtime >= expired_before:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def _qwen_session() -> requests.Session:
+    """进程内共享的HTTP会话：保持长连接，并由连接池统一处理退避重试"""
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    retry = Retry(
+        total=2,
+        backoff_factor=1.5,
+        status_forcelist=QWEN_RETRY_STATUS,
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry))
+    return session
+
+@st.cache_resource(show_spinner=False)
+def _qwen_rate_limiter() -> _RateLimiter:
+    """进程内所有会话共享同一个令牌桶，整体请求速率不超过账号配额"""
+    return _RateLimiter(QWEN_MAX_QPM)
+
+def _completion_payload(prompt: str, model: str, max_tokens: int) -> dict:
+    """构造对话补全请求体"""
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.2,
+        "max_tokens": max_tokens
+    }
+
+def _request_completion(prompt: str, model: str, max_tokens: int, api_key: str) -> Optional[str]:
+    """调用API，重试由会话的连接池负责"""
+    headers = {"Authorization": f"Bearer {api_key}"}
+    data = _completion_payload(prompt, model, max_tokens)
+    
+    try:
+        _qwen_rate_limiter().acquire()
+        response = _qwen_session().post(
+            QWEN_API_URL,
+            headers=headers,
+            json=data,
+            timeout=QWEN_TIMEOUT
+        )
+        if response.status_code == 200:
+            response_json = json_loads(response.content)
+            if "choices" in response_json and len(response_json["choices"]) > 0:
+                return response_json["choices"][0]["message"]["content"]
+    except (requests.RequestException, ValueError, KeyError, IndexError, TypeError):
+        # 网络错误或响应结构不符合预期时统一返回None，不中断整批分析
+        pass
+    
     return None
 
-def extract_text_from_pdf(file) -> str:
-    """从PDF提取文本"""
+@st.cache_data(show_spinner=False, max_entries=64)
+def extract_text_from_pdf(data: bytes) -> str:
+    """从PDF提取文本，按文件内容缓存"""
     try:
-        pdf_reader = PdfReader(file)
-        text = ""
-        for page in pdf_reader.pages:
-            page_text = page.extract_text() or ""
-            page_text = page_text.replace("  ", "").replace("\n", "").replace("\r", "")
-            text += page_text
-        return text
+        return read_pdf_text(data)
     except Exception as e:
         st.error(f"提取文本失败: {str(e)}")
         return ""
 
+@st.cache_data(show_spinner=False, max_entries=64)
 def split_into_clauses(text: str, max_clauses: int = 30) -> List[str]:
-    """分割文本为条款"""
-    patterns = [
-        r'(第[一二三四五六七八九十百]+条\s+.*?)(?=第[一二三四五六七八九十百]+条\s+|$)',
-        r'([一二三四五六七八九十]+、\s+.*?)(?=[一二三四五六七八九十]+、\s+|$)',
-        r'(\d+\.\s+.*?)(?=\d+\.\s+|$)',
-        r'(\([一二三四五六七八九十]+\)\s+.*?)(?=\([一二三四五六七八九十]+\)\s+|$)',
-        r'(\([1-9]+\)\s+.*?)(?=\([1-9]+\)\s+|$)',
-        r'(【[^\】]+】\s+.*?)(?=【[^\】]+】\s+|$)'
-    ]
-    
-    for pattern in patterns:
-        clauses = re.findall(pattern, text, re.DOTALL)
+    """分割文本为条款，按 (文本, 条款上限) 缓存"""
+    for pattern in _CLAUSE_PATTERNS:
+        clauses = pattern.findall(text)
         if len(clauses) > 3:
             return [clause.strip() for clause in clauses if clause.strip()][:max_clauses]
     
-    paragraphs = re.split(r'[。；！？]\s*', text)
+    paragraphs = _SENTENCE_SPLIT.split(text)
     return [p.strip() for p in paragraphs if p.strip() and len(p) > 10][:max_clauses]
 
-def chinese_text_similarity(text1: str, text2: str) -> float:
-    """计算中文文本相似度"""
-    words1 = list(jieba.cut(text1))
-    words2 = list(jieba.cut(text2))
-    return SequenceMatcher(None, words1, words2).ratio()
+@st.cache_resource(show_spinner=False)
+def _get_jieba():
+    """每个进程只初始化一次jieba词典，不随Streamlit重跑重复加载"""
+    jieba.dt.cache_file = str(JIEBA_CACHE_FILE)
+    jieba.initialize()
+    if LEGAL_DICT_PATH.exists():
+        jieba.load_userdict(str(LEGAL_DICT_PATH))
+    return jieba
 
-def match_clauses_with_base(base_clauses: List[str], target_clauses: List[str]) -> List[Tuple[str, str, float]]:
-    """将目标文件条款与基准文件条款匹配"""
-    matched_pairs = []
-    used_indices = set()
+@functools.lru_cache(maxsize=8192)
+def _tokenize(text: str) -> Tuple[str, ...]:
+    """分词结果按文本缓存，每条条款只分词一次
+
+    仅用于相似度计算，关闭HMM新词识别以换取分词速度。
+    """
+    return tuple(jieba.cut(text, HMM=False))
+
+@functools.lru_cache(maxsize=8192)
+def _encode_tokens(text: str) -> str:
+    """把分词序列编码为字符串，每个词语对应一个码位
+
+    RapidFuzz处理字符串时直接比较整数码位，无需逐个词语调用Python的哈希与比较。
+    关闭HMM后词语均来自词典或单字，词表规模远小于码位上限。
+    """
+    return "".join(_TOKEN_CODES.setdefault(token, chr(len(_TOKEN_CODES))) for token in _tokenize(text))
+
+def chinese_text_similarity(text1: str, text2: str, floor: float = 0.0) -> float:
+    """计算中文文本相似度（分词序列的归一化LCS相似度）；低于floor时直接返回0
+
+    数值尺度高于difflib的SequenceMatcher.ratio()，阈值含义见MATCH_THRESHOLD。
+    """
+    return fuzz.ratio(_encode_tokens(text1), _encode_tokens(text2), score_cutoff=floor * 100) / 100
+
+def match_clauses_with_base(base_clauses: List[str],
+                            target_clauses: List[str]) -> Tuple[List[Tuple[str, str, float]], List[str]]:
+    """将目标文件条款与基准文件条款匹配，返回 (匹配条款对, 未匹配的基准条款)"""
+    if not base_clauses or not target_clauses:
+        return [], list(base_clauses)
     
-    for base_clause in base_clauses:
-        best_match = None
-        best_ratio = 0.3  # 匹配阈值
-        best_idx = -1
-        
-        for idx, target_clause in enumerate(target_clauses):
-            if idx not in used_indices:
-                ratio = chinese_text_similarity(base_clause, target_clause)
-                if ratio > best_ratio and ratio > best_ratio:
-                    best_ratio = ratio
-                    best_match = target_clause
-                    best_idx = idx
-        
-        if best_match:
-            matched_pairs.append((base_clause, best_match, best_ratio))
-            used_indices.add(best_idx)
+    # 用TF-IDF余弦相似度为每条基准条款筛选候选，避免对全部目标条款逐一计算相似度
+    corpus = [" ".join(_tokenize(clause)) for clause in base_clauses + target_clauses]
+    vectors = TfidfVectorizer(analyzer="word", token_pattern=r"\S+", dtype=np.float32).fit_transform(corpus)
+    # 行向量已做L2归一化，一次稀疏矩阵乘法即得到全部余弦相似度
+    scores = (vectors[:len(base_clauses)] @ vectors[len(base_clauses):].T).toarray()
+    top_k = min(MATCH_CANDIDATES, len(target_clauses))
+    candidate_indices = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
     
-    return matched_pairs
+    # 只对候选条款对计算精确相似度，未达阈值的位置保持为0；用float64保存，避免阈值边界被舍入放行
+    ratios = np.zeros(scores.shape)
+    for base_idx, (base_clause, candidates) in enumerate(zip(base_clauses, candidate_indices)):
+        for idx in candidates:
+            # 没有任何共同词语的条款不可能达到匹配阈值
+            if scores[base_idx, idx] > 0:
+                ratios[base_idx, idx] = chinese_text_similarity(base_clause, target_clauses[idx], MATCH_THRESHOLD)
+    
+    # 全局最优分配：避免靠前的基准条款抢走更适合后续条款的目标条款
+    matched_pairs = []
+    matched_base_indices = set()
+    for base_idx, idx in zip(*linear_sum_assignment(ratios, maximize=True)):
+        ratio = float(ratios[base_idx, idx])
+        if ratio > MATCH_THRESHOLD:
+            matched_pairs.append((base_clauses[base_idx], target_clauses[idx], ratio))
+            matched_base_indices.add(base_idx)
+    
+    unmatched_base = [clause for i, clause in enumerate(base_clauses) if i not in matched_base_indices]
+    return matched_pairs, unmatched_base
 
 def analyze_compliance_with_base(base_clause: str, target_clause: str, 
                                base_name: str, target_name: str, 
@@ -150,90 +432,234 @@ def analyze_compliance_with_base(base_clause: str, target_clause: str,
     目标条款（{target_name}）：{target_clause}
     
     请重点分析：
-    1. 目标条款是否符合基准条款的要求
-    2. 存在哪些偏离或冲突之处（需具体指出）
-    3. 偏离程度评估（完全符合/轻微偏离/严重偏离）
-    4. 导致偏离的关键原因
-    5. 如何修改目标条款以符合基准要求
-    
-    请用专业、简洁的中文回答，聚焦合规性问题。
+    {ANALYSIS_CHECKLIST}
     """
     
     return call_qwen_api(prompt, api_key)
 
+def analyze_compliance_batch(pairs: List[Tuple[str, str]],
+                             base_name: str, target_name: str,
+                             api_key: str) -> List[Optional[str]]:
+    """将多对条款合并为一次请求分析，返回与输入顺序一致的分析结果"""
+    if len(pairs) == 1:
+        return [analyze_compliance_with_base(*pairs[0], base_name, target_name, api_key)]
+    
+    numbered_pairs = "\n\n".join(
+        f"第{k}组：\n基准条款（{base_name}）：{base_clause}\n目标条款（{target_name}）：{target_clause}"
+        for k, (base_clause, target_clause) in enumerate(pairs, 1)
+    )
+    prompt = f"""
+    请以{base_name}为基准，分别分析以下{len(pairs)}组条款的合规性：
+    
+    {numbered_pairs}
+    
+    对每组条款请重点分析：
+    {ANALYSIS_CHECKLIST}
+    请按编号顺序输出一个JSON数组，包含{len(pairs)}个字符串，第k个字符串为第k组的分析结果，不要输出数组以外的内容。
+    """
+    
+    result = call_qwen_api(prompt, api_key, max_tokens=len(pairs) * ANALYSIS_TOKENS_PER_PAIR)
+    if result is None:
+        # API调用本身失败（如限流或服务错误）时不再逐对重试，避免成倍增加请求
+        return [None] * len(pairs)
+    analyses = _parse_json_array(result, len(pairs))
+    if analyses is None:
+        # 收到回复但无法解析时退回逐对分析
+        return [analyze_compliance_with_base(b, t, base_name, target_name, api_key) for b, t in pairs]
+    return analyses
+
+def _parse_json_array(text: Optional[str], expected_length: int) -> Optional[List[str]]:
+    """解析模型返回的JSON数组，格式错误或数量不符时返回None"""
+    text = text or ""
+    start = text.find("[")
+    while start != -1:
+        # 从每个 "[" 处尝试解码，跳过回复前言中的 "[注]" 等非数组内容
+        try:
+            items, _ = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            items = None
+        if isinstance(items, list) and len(items) == expected_length:
+            return [item if isinstance(item, str) else json.dumps(item, ensure_ascii=False) for item in items]
+        start = text.find("[", start + 1)
+    return None
+
+def batch_pairs_by_budget(pairs: List[Tuple[str, str]]) -> List[List[Tuple[str, str]]]:
+    """按条数上限和提示词长度预算将条款对分批，长条款自动减少每批数量"""
+    batches: List[List[Tuple[str, str]]] = []
+    current: List[Tuple[str, str]] = []
+    current_tokens = 0
+    for pair in pairs:
+        # 中文约每个字符一个token，按字符数保守估算
+        pair_tokens = len(pair[0]) + len(pair[1])
+        if current and (len(current) >= ANALYSIS_BATCH_SIZE
+                        or current_tokens + pair_tokens > ANALYSIS_BATCH_PROMPT_TOKENS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(pair)
+        current_tokens += pair_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def _normalize_whitespace(text: str) -> str:
+    """去除全部空白字符，PDF提取产生的空格差异不影响比较"""
+    return "".join(text.split())
+
+def iter_compliance_analyses(matched_pairs: List[Tuple[str, str, float]],
+                             base_name: str, target_name: str,
+                             api_key: str) -> Iterator[Tuple[int, Optional[str]]]:
+    """分批并发分析各条款对，按完成顺序产出 (序号, 分析结果)，便于界面增量展示"""
+    # 相同的条款对只请求一次，结果分发给所有对应序号
+    unique_pairs: Dict[Tuple[str, str], List[int]] = {}
+    for i, (base_clause, target_clause, _) in enumerate(matched_pairs):
+        unique_pairs.setdefault((base_clause, target_clause), []).append(i)
+    
+    # 忽略空白后文本完全相同的条款对无需模型判断，直接给出结论
+    pending_pairs = []
+    for pair, indices in unique_pairs.items():
+        if _normalize_whitespace(pair[0]) == _normalize_whitespace(pair[1]):
+            for i in indices:
+                yield i, IDENTICAL_CLAUSE_ANALYSIS
+        else:
+            pending_pairs.append(pair)
+    batches = batch_pairs_by_budget(pending_pairs)
+    
+    with ThreadPoolExecutor(max_workers=QWEN_MAX_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(
+                analyze_compliance_batch,
+                batch,
+                base_name, target_name,
+                api_key
+            ): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            for pair, analysis in zip(futures[future], future.result()):
+                for i in unique_pairs[pair]:
+                    yield i, analysis
+
+def format_pair_section(index: int, pair: Tuple[str, str, float], analysis: Optional[str]) -> str:
+    """格式化单个条款对的报告段落"""
+    base_clause, target_clause, ratio = pair
+    section = StringIO()
+    section.write(f"条款对 {index+1} (相似度: {ratio:.2%})\n")
+    section.write(f"基准条款: {base_clause[:200]}...\n")
+    section.write(f"目标条款: {target_clause[:200]}...\n\n")
+    if analysis:
+        section.write("合规性分析结果:\n")
+        section.write(f"{analysis}\n")
+    else:
+        section.write("合规性分析结果: 无法获取有效的分析结果\n")
+    section.write("\n" + "-"*60 + "\n\n")
+    return section.getvalue()
+
+def build_target_summary_prompt(pair_count: int, base_name: str, target_name: str) -> str:
+    """构造目标文件总体评估的提示词"""
+    return f"""
+            基于对{target_name}与基准文件{base_name}的{pair_count}对条款的对比分析，
+            请评估{target_name}整体符合基准的程度，包括：
+            1. 总体合规性评分（1-10分）及理由
+            2. 最主要的不合规点
+            3. 整体修改建议
+            """
+
 def generate_target_report(matched_pairs: List[Tuple[str, str, float]],
                           base_name: str, target_name: str,
-                          api_key: str, target_index: int, total_targets: int) -> str:
+                          api_key: str, target_index: int, total_targets: int,
+                          unmatched_base: Optional[List[str]] = None) -> str:
     """为单个目标文件生成与基准文件的对比报告"""
-    report = []
-    report.append("="*60)
-    report.append(f"条款合规性分析报告: {target_name} 与 {base_name} 对比")
-    report.append(f"生成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    report.append("="*60 + "\n")
+    report = StringIO()
+    report.write("="*60 + "\n")
+    report.write(f"条款合规性分析报告: {target_name} 与 {base_name} 对比\n")
+    report.write(f"生成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+    report.write("="*60 + "\n\n")
     
     # 总体统计
-    report.append(f"分析概要: 共匹配 {len(matched_pairs)} 条条款\n")
-    report.append("-"*60 + "\n")
+    report.write(f"分析概要: 共匹配 {len(matched_pairs)} 条条款\n\n")
+    report.write("-"*60 + "\n\n")
+    header = report.getvalue()
     
-    # 进度跟踪
+    # 进度跟踪：每个文件最多刷新约20次，且两次刷新间隔不少于0.1秒
     progress_container = st.empty()
     total_pairs = len(matched_pairs)
+    progress_step = max(1, total_pairs // 20)
+    last_progress_update = 0.0
     
-    # 分析每对条款
-    for i, (base_clause, target_clause, ratio) in enumerate(matched_pairs):
-        # 更新全局进度 (考虑多个目标文件的总进度)
-        global_progress = (target_index * total_pairs + i) / (total_targets * total_pairs) if total_targets > 0 else 0
-        st.session_state.analysis_progress = global_progress
-        progress_container.progress(global_progress)
-        
-        report.append(f"条款对 {i+1} (相似度: {ratio:.2%})")
-        report.append(f"基准条款: {base_clause[:200]}...")
-        report.append(f"目标条款: {target_clause[:200]}...\n")
-        
-        # 合规性分析
-        with st.spinner(f"正在分析 {target_name} 的条款 {i+1}/{total_pairs}..."):
-            analysis = analyze_compliance_with_base(
-                base_clause, target_clause, 
-                base_name, target_name, 
-                api_key
+    # 预先为每对条款占位，结果返回后立即展示
+    with st.expander(f"{target_name} 实时分析结果", expanded=True):
+        placeholders = [st.empty() for _ in matched_pairs]
+    sections: List[str] = [""] * total_pairs
+    
+    # 总体评估不依赖逐条结果，与条款分析同时发出请求
+    summary_executor = ThreadPoolExecutor(max_workers=1)
+    summary_future = summary_executor.submit(
+        call_qwen_api, build_target_summary_prompt(len(matched_pairs), base_name, target_name), api_key,
+        TARGET_SUMMARY_MAX_TOKENS
+    ) if matched_pairs else None
+    summary_executor.shutdown(wait=False)
+    
+    with st.spinner(f"正在分析 {target_name} 的 {total_pairs} 对条款..."):
+        for done, (i, analysis) in enumerate(
+                iter_compliance_analyses(matched_pairs, base_name, target_name, api_key), 1):
+            sections[i] = format_pair_section(i, matched_pairs[i], analysis)
+            placeholders[i].markdown(
+                f"**条款对 {i+1}**（相似度: {matched_pairs[i][2]:.2%}）\n\n"
+                f"{analysis or '无法获取有效的分析结果'}"
             )
-        
-        if analysis:
-            report.append("合规性分析结果:")
-            report.append(analysis)
-        else:
-            report.append("合规性分析结果: 无法获取有效的分析结果")
-        
-        report.append("\n" + "-"*60 + "\n")
-        
-        # 保存部分结果
-        st.session_state.partial_reports[target_name] = report.copy()
-        time.sleep(1)  # 控制API调用频率
+            
+            # 更新全局进度 (考虑多个目标文件的总进度)
+            global_progress = (target_index * total_pairs + done) / (total_targets * total_pairs) if total_targets > 0 else 0
+            st.session_state.analysis_progress = global_progress
+            now = time.monotonic()
+            if done == total_pairs or (done % progress_step == 0 and now - last_progress_update > 0.1):
+                progress_container.progress(global_progress)
+                last_progress_update = now
+            
+            # 保存部分结果
+            st.session_state.partial_reports[target_name] = header + "".join(sections)
+    
+    for section in sections:
+        report.write(section)
+    
+    # 目标文件中没有对应条款的基准条款
+    if unmatched_base:
+        report.write(f"未匹配的基准条款: 共 {len(unmatched_base)} 条（目标文件中未找到对应内容）\n")
+        for i, clause in enumerate(unmatched_base, 1):
+            report.write(f"{i}. {clause[:200]}...\n")
+        report.write("\n" + "-"*60 + "\n\n")
     
     # 目标文件总体评估
-    if matched_pairs:
+    if summary_future:
         with st.spinner(f"生成 {target_name} 的总体评估..."):
-            summary_prompt = f"""
-            基于对{target_name}与基准文件{base_name}的{len(matched_pairs)}对条款的对比分析，
-            请评估{target_name}整体符合基准的程度，包括：
-            1. 总体合规性评分（1-10分）及理由
-            2. 最主要的不合规点
-            3. 整体修改建议
-            """
-            summary = call_qwen_api(summary_prompt, api_key)
+            summary = summary_future.result()
             
             if summary:
-                report.append("="*60)
-                report.append(f"{target_name} 与 {base_name} 总体合规性评估")
-                report.append("="*60)
-                report.append(summary)
+                report.write("="*60 + "\n")
+                report.write(f"{target_name} 与 {base_name} 总体合规性评估\n")
+                report.write("="*60 + "\n")
+                report.write(f"{summary}\n")
     
-    return "\n".join(report)
+    return report.getvalue()
+
+def _report_excerpt(report: str, limit: int) -> str:
+    """按整行截取报告开头不超过limit个字符的内容
+
+    省略生成时间行，使相同的分析结果生成相同的提示词，从而命中响应缓存。
+    """
+    text = "\n".join(line for line in report.splitlines() if not line.startswith("生成时间:"))
+    if len(text) <= limit:
+        return text
+    # 完整保留预算内的行，超出预算的行只保留能容纳的部分；省略标记占用的字符也计入预算
+    marker = "\n..."
+    if limit <= len(marker):
+        return text[:limit]
+    return text[:limit - len(marker)].rstrip("\n") + marker
 
-def generate_combined_summary(reports: dict, base_name: str, api_key: str) -> Optional[str]:
-    """生成所有文件与基准对比的综合摘要"""
+def generate_combined_summary(reports: dict, base_name: str, api_key: str) -> Iterator[str]:
+    """流式生成所有文件与基准对比的综合摘要，逐段产出文本"""
     if not reports:
-        return None
+        return iter(())
         
     target_names = list(reports.keys())
     summary_prompt = f"""
@@ -242,10 +668,11 @@ def generate_combined_summary(reports: dict, base_name: str, api_key: str) -> Op
     
     """
     
-    # 为每个目标文件添加关键信息
+    # 为每个目标文件添加关键信息，总长度按预算在各文件间平均分配
+    per_report_chars = max(1000, SUMMARY_INPUT_CHARS // len(reports))
     for name, report in reports.items():
         summary_prompt += f"文件 {name} 的分析要点：\n"
-        summary_prompt += f"{report[:1000]}...\n\n"  # 取报告开头部分作为摘要依据
+        summary_prompt += f"{_report_excerpt(report, per_report_chars)}\n\n"
     
     summary_prompt += """
     请基于以上信息，生成综合评估：
@@ -255,7 +682,23 @@ def generate_combined_summary(reports: dict, base_name: str, api_key: str) -> Op
     4. 针对所有文件的优先级修改建议
     """
     
-    return call_qwen_api(summary_prompt, api_key)
+    # 输出长度随文件数增长，文件较少时避免生成冗长的套话
+    max_tokens = min(QWEN_MAX_TOKENS, SUMMARY_BASE_TOKENS + SUMMARY_TOKENS_PER_FILE * len(reports))
+    return stream_qwen_api(summary_prompt, api_key, max_tokens)
+
+def dedupe_uploads(files: list) -> Tuple[list, List[Tuple[str, str]]]:
+    """按文件内容去重，返回 (保留的文件, [(重复文件名, 首次出现的文件名)])"""
+    seen: Dict[bytes, str] = {}
+    unique_files = []
+    duplicates = []
+    for file in files:
+        digest = hashlib.blake2b(file.getvalue(), digest_size=16).digest()
+        if digest in seen:
+            duplicates.append((file.name, seen[digest]))
+        else:
+            seen[digest] = file.name
+            unique_files.append(file)
+    return unique_files, duplicates
 
 def get_download_link(text: str, filename: str) -> str:
     """生成报告下载链接"""
@@ -263,6 +706,7 @@ def get_download_link(text: str, filename: str) -> str:
     return f'<a href="data:text/plain;base64,{b64}" download="{filename}" style="display:inline-block;padding:8px 16px;background-color:#007bff;color:white;text-decoration:none;border-radius:4px;margin:5px 0;">下载 {filename}</a>'
 
 def main():
+    _get_jieba()
     st.title("多文件基准合规性分析工具")
     st.write("上传一个基准文件和多个目标文件，系统将分析所有目标文件与基准文件的条款合规性")
     
@@ -290,7 +734,7 @@ def main():
         try:
             # 处理基准文件
             with st.spinner("正在处理基准文件..."):
-                base_text = extract_text_from_pdf(base_file)
+                base_text = extract_text_from_pdf(base_file.getvalue())
                 if not base_text:
                     st.error("无法从基准文件中提取文本")
                     return
@@ -298,20 +742,28 @@ def main():
                 base_clauses = split_into_clauses(base_text, max_clauses)
                 st.success(f"基准文件处理完成: {base_file.name} 提取到 {len(base_clauses)} 条条款")
             
+            # 内容完全相同的目标文件只分析一次
+            target_files, duplicates = dedupe_uploads(target_files)
+            for duplicate_name, original_name in duplicates:
+                st.warning(f"{duplicate_name} 与 {original_name} 内容相同，已跳过")
+            
             # 准备存储所有报告
             all_reports = {}
             total_targets = len(target_files)
             
+            # 先提取所有目标文件的文本；PDFium同一进程内只能串行调用，结果按文件内容缓存
+            with st.spinner(f"正在提取 {total_targets} 个目标文件的文本..."):
+                target_texts = [extract_text_from_pdf(f.getvalue()) for f in target_files]
+            
             # 显示总体进度
             global_progress_bar = st.progress(0)
             
             # 处理每个目标文件
-            for target_idx, target_file in enumerate(target_files, 1):
+            for target_idx, (target_file, target_text) in enumerate(zip(target_files, target_texts), 1):
                 st.subheader(f"正在分析目标文件 {target_idx}/{total_targets}: {target_file.name}")
                 
-                # 提取目标文件文本和条款
+                # 提取目标文件条款
                 with st.spinner(f"提取 {target_file.name} 的条款..."):
-                    target_text = extract_text_from_pdf(target_file)
                     if not target_text:
                         st.warning(f"无法从 {target_file.name} 中提取文本，跳过该文件")
                         continue
@@ -321,13 +773,13 @@ def main():
                 
                 # 匹配条款
                 with st.spinner(f"匹配 {target_file.name} 与基准文件的条款..."):
-                    matched_pairs = match_clauses_with_base(base_clauses, target_clauses)
+                    matched_pairs, unmatched_base = match_clauses_with_base(base_clauses, target_clauses)
                     
                     if not matched_pairs:
                         st.warning(f"{target_file.name} 未找到与基准文件匹配的条款，无法分析")
                         continue
                     
-                    st.info(f"找到 {len(matched_pairs)} 对可对比的条款")
+                    st.info(f"找到 {len(matched_pairs)} 对可对比的条款，{len(unmatched_base)} 条基准条款未匹配")
                 
                 # 生成分析报告
                 report = generate_target_report(
@@ -336,7 +788,8 @@ def main():
                     target_file.name,
                     api_key,
                     target_idx - 1,  # 0-based index
-                    total_targets
+                    total_targets,
+                    unmatched_base
                 )
                 
                 all_reports[target_file.name] = report
@@ -354,14 +807,21 @@ def main():
             
             # 生成综合摘要（如果有多个目标文件）
             if len(all_reports) > 1:
-                with st.spinner("生成所有文件的综合合规性摘要..."):
-                    combined_summary = generate_combined_summary(all_reports, base_file.name, api_key)
-                    
-                    if combined_summary:
-                        st.subheader("📋 所有文件综合合规性评估")
-                        st.text_area("综合评估内容", combined_summary, height=400)
-                        summary_filename = f"所有文件与{base_file.name}_综合评估.txt"
-                        st.markdown(get_download_link(combined_summary, summary_filename), unsafe_allow_html=True)
+                st.subheader("📋 所有文件综合合规性评估")
+                # 边生成边展示，无需等待完整回答
+                with st.container(border=True):
+                    combined_summary = st.write_stream(
+                        generate_combined_summary(all_reports, base_file.name, api_key)
+                    )
+                
+                if combined_summary:
+                    summary_filename = f"所有文件与{base_file.name}_综合评估.txt"
+                    if combined_summary.endswith(STREAM_INTERRUPTED_NOTICE):
+                        st.warning("综合评估生成中断，内容不完整，可稍后重新分析")
+                        summary_filename = f"部分_{summary_filename}"
+                    st.markdown(get_download_link(combined_summary, summary_filename), unsafe_allow_html=True)
+                else:
+                    st.warning("无法生成综合合规性评估")
             
             # 最终提示
             st.balloons()
@@ -374,8 +834,7 @@ def main():
             if st.session_state.partial_reports:
                 st.warning("已完成部分分析结果：")
                 for name, partial_report in st.session_state.partial_reports.items():
-                    report_text = "\n".join(partial_report)
-                    st.markdown(get_download_link(report_text, f"部分_{name}_vs_{base_file.name}_合规性报告.txt"), unsafe_allow_html=True)
+                    st.markdown(get_download_link(partial_report, f"部分_{name}_vs_{base_file.name}_合规性报告.txt"), unsafe_allow_html=True)
 
 if __name__ == "__main__":
     main()